@@ -0,0 +1,40 @@
+# CPU-bound crypto operations. These run in a process pool (see server.py),
+# so they only take picklable arguments and keep no per-process secrets.
+import hashlib
+import hmac
+
+import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cryptography.fernet import Fernet
+
+# Password hashing (legacy bcrypt hashes are verified and re-hashed on login)
+password_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
+
+
+def is_bcrypt_hash(hashed: str) -> bool:
+    return hashed.startswith("$2")
+
+def hash_password(password: str) -> str:
+    return password_hasher.hash(password)
+
+def verify_password(password: str, hashed: str) -> bool:
+    if is_bcrypt_hash(hashed):
+        return bcrypt.checkpw(password.encode(), hashed.encode())
+    try:
+        return password_hasher.verify(hashed, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(hashed: str) -> bool:
+    return is_bcrypt_hash(hashed) or password_hasher.check_needs_rehash(hashed)
+
+def hash_backup_code(key: str, code: str) -> str:
+    # Keyed so that a leaked database alone can't brute-force the 32-bit codes
+    return hmac.new(key.encode(), code.encode(), hashlib.sha256).hexdigest()
+
+def encrypt(key: bytes, data: bytes) -> bytes:
+    return Fernet(key).encrypt(data)
+
+def decrypt(key: bytes, token: bytes) -> bytes:
+    return Fernet(key).decrypt(token)
@@ -0,0 +1,54 @@
+# One-off migration: replace 2FA backup codes stored in plaintext (issued
+# before codes were hashed) with {"h": HMAC-SHA256} entries, so no plaintext
+# codes remain at rest. Run once from backend/:  python migrate_backup_codes.py
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient, UpdateOne
+
+import crypto_ops
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+BACKUP_CODE_KEY = os.environ['BACKUP_CODE_KEY']
+BATCH_SIZE = 1000
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+async def main() -> None:
+    client = AsyncMongoClient(os.environ['MONGO_URL'])
+    users = client[os.environ['DB_NAME']].users
+    converted = 0
+    batch = []
+    try:
+        async for user in users.find({"backup_codes": {"$type": "string"}}, {"backup_codes": 1}):
+            codes = [
+                {"h": crypto_ops.hash_backup_code(BACKUP_CODE_KEY, code)} if isinstance(code, str) else code
+                for code in user["backup_codes"]
+            ]
+            # Only rewrite the array if it hasn't changed since it was read
+            batch.append(UpdateOne(
+                {"_id": user["_id"], "backup_codes": user["backup_codes"]},
+                {"$set": {"backup_codes": codes}}
+            ))
+            if len(batch) == BATCH_SIZE:
+                converted += (await users.bulk_write(batch, ordered=False)).modified_count
+                batch = []
+        if batch:
+            converted += (await users.bulk_write(batch, ordered=False)).modified_count
+        logger.info("Hashed plaintext backup codes for %d users", converted)
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
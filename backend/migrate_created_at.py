@@ -0,0 +1,55 @@
+# One-off migration: convert ISO-string created_at values (written before
+# created_at became epoch seconds) to ints, since Mongo sorts strings after
+# every number. Run once from backend/:  python migrate_created_at.py
+import asyncio
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient, UpdateOne
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+BATCH_SIZE = 1000
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+async def migrate_collection(collection) -> None:
+    converted = 0
+    batch = []
+    async for doc in collection.find({"created_at": {"$type": "string"}}, {"created_at": 1}):
+        try:
+            created_at = int(datetime.fromisoformat(doc["created_at"]).timestamp())
+        except ValueError:
+            logger.error("Skipping %s %s: unparseable created_at %r", collection.name, doc["_id"], doc["created_at"])
+            continue
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"created_at": created_at}}))
+        if len(batch) == BATCH_SIZE:
+            await collection.bulk_write(batch, ordered=False)
+            converted += len(batch)
+            batch = []
+    if batch:
+        await collection.bulk_write(batch, ordered=False)
+        converted += len(batch)
+    logger.info("Converted created_at to epoch seconds on %d %s documents", converted, collection.name)
+
+async def main() -> None:
+    client = AsyncMongoClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        for collection in (db.users, db.backups):
+            await migrate_collection(collection)
+    finally:
+        await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,34 +1,51 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Body
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, Form, UploadFile, Body, Request, Response
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from gridfs import AsyncGridFSBucket
+from gridfs.errors import NoFile
+import redis.asyncio as redis
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
+from pydantic import BaseModel, EmailStr
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
-import bcrypt
+import time
+import asyncio
+import hashlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import jwt
 import pyotp
-import qrcode
+import segno
 import base64
 from io import BytesIO
 from cryptography.fernet import Fernet
+from cachetools import TLRUCache, TTLCache
+import crypto_ops
 import json
+import orjson
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncMongoClient(mongo_url, maxPoolSize=100, minPoolSize=10)
 db = client[os.environ['DB_NAME']]
+backup_files = AsyncGridFSBucket(db, bucket_name="backup_files")
+
+# Redis connection (presence)
+redis_client = redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'), decode_responses=True)
 
 # Create the main app without a prefix
-app = FastAPI(title="JustP2P Messenger API")
+app = FastAPI(title="JustP2P Messenger API", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -37,10 +54,49 @@ api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 JWT_ALGORITHM = "HS256"
+ACCESS_TOKEN_TTL = 7 * 24 * 60 * 60  # seconds
+# Separate from JWT_SECRET so rotating that doesn't invalidate backup codes
+BACKUP_CODE_KEY = os.environ['BACKUP_CODE_KEY']
 
 # Encryption key for backups
 ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', Fernet.generate_key().decode())
-fernet = Fernet(ENCRYPTION_KEY.encode())
+
+# Process pool for password hashing and backup encryption, created at startup.
+# Until then (or if it is never started) the default thread pool is used. Each
+# argon2 hash can use 64 MiB, so keep the pool small.
+CRYPTO_WORKERS = int(os.environ.get('CRYPTO_WORKERS', min(4, os.cpu_count() or 1)))
+crypto_executor: Optional[ProcessPoolExecutor] = None
+
+# Auth caches: decoded JWT payloads keyed by token digest (expire at the token's
+# exp claim, capped at 60s) and user documents keyed by user id.
+_TOKEN_CACHE = TLRUCache(
+    maxsize=10_000,
+    ttu=lambda _key, payload, now: min(now + 60, payload["exp"]),
+    timer=time.time,
+)
+_USER_CACHE = TTLCache(maxsize=10_000, ttl=60)
+# Per-user generation, bumped on every invalidation from a global counter so
+# values are never reused; a cache miss only stores its result if the
+# generation did not change while it was reading from Mongo.
+_USER_GENERATIONS = TTLCache(maxsize=100_000, ttl=300)
+_generation_counter = itertools.count(1)
+
+# Pending online-status writes, flushed to MongoDB in batches
+STATUS_FLUSH_INTERVAL = 1.0
+_status_buffer: dict[str, dict] = {}
+
+# Presence: a sorted set of user ids scored by last heartbeat, plus a hash of
+# user id -> {"username", "current_peer_id"}
+PRESENCE_KEY = "presence:online"
+PRESENCE_INFO_KEY = "presence:info"
+PRESENCE_TTL = 30  # seconds without a heartbeat before a user counts as offline
+PRESENCE_PRUNE_INTERVAL = 60.0
+
+_background_tasks: List[asyncio.Task] = []
+
+# In-flight password checks, so identical concurrent logins share one hash
+LOGIN_COALESCE_TIMEOUT = 0.5  # seconds to wait on another request's check
+_login_inflight: dict[tuple, asyncio.Future] = {}
 
 
 # ===== MODELS =====
@@ -54,20 +110,6 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
-class User(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    email: str
-    username: str
-    password_hash: str
-    current_peer_id: Optional[str] = None
-    online_status: bool = False
-    totp_secret: Optional[str] = None
-    totp_enabled: bool = False
-    backup_codes: List[str] = []
-    passkey_credentials: List[dict] = []
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-
 class TokenResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
@@ -87,56 +129,217 @@ class UsernameLookup(BaseModel):
 class UpdatePeerID(BaseModel):
     peer_id: str
 
-class BackupUpload(BaseModel):
-    filename: str
-    data: str  # base64 encoded encrypted data
-    provider: str  # 'local', 'gdrive', 'onedrive', 'dropbox'
-
-class BackupMetadata(BaseModel):
-    model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    user_id: str
-    filename: str
-    provider: str
-    encrypted_data: Optional[str] = None  # For local storage
-    cloud_file_id: Optional[str] = None  # For cloud storage
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-
 
 # ===== HELPER FUNCTIONS =====
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+def new_crypto_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=CRYPTO_WORKERS,
+        mp_context=multiprocessing.get_context("spawn")
+    )
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode(), hashed.encode())
+async def run_crypto(func, *args, retry: bool = True):
+    global crypto_executor
+    loop = asyncio.get_running_loop()
+    executor = crypto_executor
+    try:
+        return await loop.run_in_executor(executor, func, *args)
+    except BrokenProcessPool:
+        # A worker died; replace the pool (once, even if many calls saw it
+        # break). Only small, bounded jobs are retried on the fresh pool: a
+        # job that itself killed the worker (e.g. OOM on a huge backup) would
+        # just take the new pool down too.
+        if crypto_executor is executor:
+            logger.error("Crypto process pool broke; starting a new one")
+            executor.shutdown(wait=False)
+            crypto_executor = new_crypto_executor()
+        if not retry:
+            raise
+        return await loop.run_in_executor(crypto_executor, func, *args)
+
+async def hash_password(password: str) -> str:
+    return await run_crypto(crypto_ops.hash_password, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await run_crypto(crypto_ops.verify_password, password, hashed)
+
+async def verify_password_coalesced(password: str, hashed: str) -> bool:
+    # Keyed on the stored hash and a digest of the attempted password, so only
+    # requests that would compute the exact same result are coalesced.
+    key = (hashed, hashlib.blake2b(password.encode(), digest_size=16).digest())
+    pending = _login_inflight.get(key)
+    if pending is not None:
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending), LOGIN_COALESCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Fall back to our own check only if the leader was cancelled, not
+            # this request
+            if not pending.cancelled() or asyncio.current_task().cancelling():
+                raise
+        return await verify_password(password, hashed)
+    
+    pending = asyncio.get_running_loop().create_future()
+    _login_inflight[key] = pending
+    try:
+        result = await verify_password(password, hashed)
+    except BaseException:
+        pending.cancel()
+        raise
+    else:
+        pending.set_result(result)
+        return result
+    finally:
+        del _login_inflight[key]
+
+def password_needs_rehash(hashed: str) -> bool:
+    return crypto_ops.password_needs_rehash(hashed)
 
 def create_access_token(user_id: str, email: str) -> str:
     payload = {
         "user_id": user_id,
         "email": email,
-        "exp": datetime.utcnow() + timedelta(days=7)
+        "exp": int(time.time()) + ACCESS_TOKEN_TTL
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+def _token_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
 def decode_token(token: str) -> dict:
+    key = _token_key(token)
+    payload = _TOKEN_CACHE.get(key)
+    if payload is not None:
+        return payload
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    _TOKEN_CACHE[key] = payload
+    return payload
+
+def invalidate_user_cache(user_id: str) -> None:
+    _USER_GENERATIONS[user_id] = next(_generation_counter)
+    _USER_CACHE.pop(user_id, None)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     payload = decode_token(token)
-    user = await db.users.find_one({"id": payload["user_id"]}, {"_id": 0})
+    user = _USER_CACHE.get(payload["user_id"])
+    if user is not None:
+        return user
+    generation = _USER_GENERATIONS.get(payload["user_id"], 0)
+    user = await db.users.find_one(
+        {"id": payload["user_id"]},
+        {"_id": 0, "id": 1, "email": 1, "username": 1, "totp_enabled": 1, "current_peer_id": 1, "online_status": 1}
+    )
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
+    if _USER_GENERATIONS.get(payload["user_id"], 0) == generation:
+        _USER_CACHE[payload["user_id"]] = user
     return user
 
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match may list several tags, use the weak W/ form, or be "*"
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def cacheable_response(request: Request, payload, cache_control: str) -> Response:
+    body = orjson.dumps(payload)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Authorization"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def queue_status_update(user_id: str, fields: dict) -> None:
+    _status_buffer.setdefault(user_id, {}).update(fields)
+
+async def flush_status_updates() -> None:
+    global _status_buffer
+    if not _status_buffer:
+        return
+    pending, _status_buffer = _status_buffer, {}
+    try:
+        await db.users.bulk_write(
+            [UpdateOne({"id": user_id}, {"$set": fields}) for user_id, fields in pending.items()],
+            ordered=False
+        )
+    except BaseException:
+        # Put the batch back for the next flush; updates queued meanwhile win
+        for user_id, fields in pending.items():
+            _status_buffer[user_id] = {**fields, **_status_buffer.get(user_id, {})}
+        raise
+    for user_id in pending:
+        invalidate_user_cache(user_id)
+
+async def run_status_flusher() -> None:
+    while True:
+        await asyncio.sleep(STATUS_FLUSH_INTERVAL)
+        try:
+            await flush_status_updates()
+        except Exception:
+            logger.exception("Failed to flush online status updates")
+
+def verify_totp(secret: str, code: str) -> bool:
+    # Accept the previous and next 30s step to tolerate clock drift; pyotp
+    # compares each candidate with hmac.compare_digest.
+    return pyotp.TOTP(secret).verify(code, valid_window=1)
+
+async def set_presence(user_id: str, username: str, peer_id: str) -> None:
+    info = json.dumps({"username": username, "current_peer_id": peer_id})
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zadd(PRESENCE_KEY, {user_id: time.time()})
+        pipe.hset(PRESENCE_INFO_KEY, user_id, info)
+        await pipe.execute()
+
+async def clear_presence(*user_ids: str) -> None:
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zrem(PRESENCE_KEY, *user_ids)
+        pipe.hdel(PRESENCE_INFO_KEY, *user_ids)
+        await pipe.execute()
+
+# Drops members scored at or below ARGV[1] from the presence set and their info
+# from the hash in one atomic step, so a concurrent heartbeat is never lost.
+# Returns the pruned user ids.
+_prune_presence_script = redis_client.register_script("""
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #stale > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    for i = 1, #stale, 1000 do
+        redis.call('HDEL', KEYS[2], unpack(stale, i, math.min(i + 999, #stale)))
+    end
+end
+return stale
+""")
+
+async def prune_presence() -> None:
+    stale = await _prune_presence_script(keys=[PRESENCE_KEY, PRESENCE_INFO_KEY], args=[time.time() - 2 * PRESENCE_TTL])
+    # Clients that vanished without calling set-offline are offline in Mongo too
+    for user_id in stale:
+        queue_status_update(user_id, {"online_status": False})
+
+async def run_presence_pruner() -> None:
+    while True:
+        await asyncio.sleep(PRESENCE_PRUNE_INTERVAL)
+        try:
+            await prune_presence()
+        except Exception:
+            logger.exception("Failed to prune stale presence entries")
+
 def generate_backup_codes(count: int = 8) -> List[str]:
-    return [str(uuid.uuid4())[:8].upper() for _ in range(count)]
+    # One urandom read for all codes; each code is 4 random bytes as 8 hex chars
+    raw = os.urandom(count * 4).hex().upper()
+    return [raw[i:i + 8] for i in range(0, len(raw), 8)]
+
+def hash_backup_code(code: str) -> str:
+    return crypto_ops.hash_backup_code(BACKUP_CODE_KEY, code)
 
 
 # ===== AUTH ENDPOINTS =====
@@ -144,42 +347,64 @@ def generate_backup_codes(count: int = 8) -> List[str]:
 @api_router.post("/auth/register", response_model=TokenResponse)
 async def register(user_data: UserRegister):
     # Check if user exists
-    existing = await db.users.find_one({"$or": [{"email": user_data.email}, {"username": user_data.username}]}, {"_id": 0})
-    if existing:
+    existing = await asyncio.gather(
+        db.users.find_one({"email": user_data.email}, {"_id": 0, "id": 1}),
+        db.users.find_one({"username": user_data.username}, {"_id": 0, "id": 1})
+    )
+    if any(existing):
         raise HTTPException(status_code=400, detail="Email or username already exists")
     
     # Create user
-    user = User(
-        email=user_data.email,
-        username=user_data.username,
-        password_hash=hash_password(user_data.password)
-    )
-    
-    user_dict = user.model_dump()
-    user_dict['created_at'] = user_dict['created_at'].isoformat()
-    
-    await db.users.insert_one(user_dict)
+    user = {
+        "id": str(uuid.uuid4()),
+        "email": user_data.email,
+        "username": user_data.username,
+        "password_hash": await hash_password(user_data.password),
+        "current_peer_id": None,
+        "online_status": False,
+        "totp_secret": None,
+        "totp_enabled": False,
+        "backup_codes": [],  # [{"h": HMAC-SHA256 hex digest of the code}]
+        "passkey_credentials": [],
+        "created_at": int(time.time())
+    }
+    try:
+        await db.users.insert_one(user)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same email/username
+        raise HTTPException(status_code=400, detail="Email or username already exists")
     
     # Create token
-    token = create_access_token(user.id, user.email)
+    token = create_access_token(user["id"], user["email"])
     
     return {
         "access_token": token,
         "token_type": "bearer",
         "user": {
-            "id": user.id,
-            "email": user.email,
-            "username": user.username,
-            "totp_enabled": user.totp_enabled
+            "id": user["id"],
+            "email": user["email"],
+            "username": user["username"],
+            "totp_enabled": user["totp_enabled"]
         }
     }
 
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
-    user = await db.users.find_one({"email": credentials.email}, {"_id": 0})
-    if not user or not verify_password(credentials.password, user["password_hash"]):
+    user = await db.users.find_one(
+        {"email": credentials.email},
+        {"_id": 0, "id": 1, "email": 1, "username": 1, "password_hash": 1, "totp_enabled": 1, "current_peer_id": 1}
+    )
+    if not user or not await verify_password_coalesced(credentials.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade legacy bcrypt hashes to argon2id
+    if password_needs_rehash(user["password_hash"]):
+        await db.users.update_one(
+            {"id": user["id"]},
+            {"$set": {"password_hash": await hash_password(credentials.password)}}
+        )
+        invalidate_user_cache(user["id"])
+    
     token = create_access_token(user["id"], user["email"])
     
     return {
@@ -195,15 +420,15 @@ async def login(credentials: UserLogin):
     }
 
 @api_router.get("/auth/me")
-async def get_me(current_user: dict = Depends(get_current_user)):
-    return {
+async def get_me(request: Request, current_user: dict = Depends(get_current_user)):
+    return cacheable_response(request, {
         "id": current_user["id"],
         "email": current_user["email"],
         "username": current_user["username"],
         "totp_enabled": current_user.get("totp_enabled", False),
         "current_peer_id": current_user.get("current_peer_id"),
         "online_status": current_user.get("online_status", False)
-    }
+    }, "private, max-age=5")
 
 
 # ===== 2FA ENDPOINTS =====
@@ -222,20 +447,16 @@ async def setup_2fa(current_user: dict = Depends(get_current_user)):
         issuer_name="JustP2P"
     )
     
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(totp_uri)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
     buffer = BytesIO()
-    img.save(buffer, format="PNG")
+    segno.make(totp_uri, error="m").save(buffer, kind="png", scale=10, border=5)
     qr_code_base64 = base64.b64encode(buffer.getvalue()).decode()
     
     # Store secret temporarily (will be enabled after verification)
     await db.users.update_one(
         {"id": current_user["id"]},
-        {"$set": {"totp_secret": secret, "backup_codes": backup_codes}}
+        {"$set": {"totp_secret": secret, "backup_codes": [{"h": hash_backup_code(code)} for code in backup_codes]}}
     )
+    invalidate_user_cache(current_user["id"])
     
     return {
         "qr_code": f"data:image/png;base64,{qr_code_base64}",
@@ -245,29 +466,28 @@ async def setup_2fa(current_user: dict = Depends(get_current_user)):
 
 @api_router.post("/auth/2fa/verify")
 async def verify_2fa(verify_data: TwoFAVerify, current_user: dict = Depends(get_current_user)):
-    user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0})
+    user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0, "totp_secret": 1})
     
     if not user.get("totp_secret"):
         raise HTTPException(status_code=400, detail="2FA not setup")
     
-    totp = pyotp.TOTP(user["totp_secret"])
-    
     # Check TOTP code
-    if totp.verify(verify_data.code):
+    if verify_totp(user["totp_secret"], verify_data.code):
         await db.users.update_one(
             {"id": current_user["id"]},
             {"$set": {"totp_enabled": True}}
         )
+        invalidate_user_cache(current_user["id"])
         return {"success": True, "message": "2FA enabled successfully"}
     
-    # Check backup codes
-    if verify_data.code in user.get("backup_codes", []):
-        # Remove used backup code
-        new_codes = [code for code in user["backup_codes"] if code != verify_data.code]
-        await db.users.update_one(
-            {"id": current_user["id"]},
-            {"$set": {"backup_codes": new_codes, "totp_enabled": True}}
-        )
+    # Check and consume a backup code in one atomic update
+    code_match = {"h": hash_backup_code(verify_data.code)}
+    result = await db.users.update_one(
+        {"id": current_user["id"], "backup_codes": code_match},
+        {"$pull": {"backup_codes": code_match}, "$set": {"totp_enabled": True}}
+    )
+    if result.modified_count:
+        invalidate_user_cache(current_user["id"])
         return {"success": True, "message": "2FA verified with backup code"}
     
     raise HTTPException(status_code=400, detail="Invalid code")
@@ -278,6 +498,7 @@ async def disable_2fa(current_user: dict = Depends(get_current_user)):
         {"id": current_user["id"]},
         {"$set": {"totp_enabled": False, "totp_secret": None, "backup_codes": []}}
     )
+    invalidate_user_cache(current_user["id"])
     return {"success": True, "message": "2FA disabled"}
 
 
@@ -285,7 +506,10 @@ async def disable_2fa(current_user: dict = Depends(get_current_user)):
 
 @api_router.post("/users/lookup")
 async def lookup_username(lookup: UsernameLookup):
-    user = await db.users.find_one({"username": lookup.username}, {"_id": 0})
+    user = await db.users.find_one(
+        {"username": lookup.username},
+        {"_id": 0, "username": 1, "current_peer_id": 1, "online_status": 1}
+    )
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -297,53 +521,73 @@ async def lookup_username(lookup: UsernameLookup):
 
 @api_router.post("/users/update-peer-id")
 async def update_peer_id(update: UpdatePeerID, current_user: dict = Depends(get_current_user)):
-    await db.users.update_one(
-        {"id": current_user["id"]},
-        {"$set": {"current_peer_id": update.peer_id, "online_status": True}}
-    )
+    # Heartbeats repeat the same peer id; only write to Mongo when it changes
+    known = {**current_user, **_status_buffer.get(current_user["id"], {})}
+    if known.get("current_peer_id") != update.peer_id or not known.get("online_status"):
+        queue_status_update(current_user["id"], {"current_peer_id": update.peer_id, "online_status": True})
+    await set_presence(current_user["id"], current_user["username"], update.peer_id)
     return {"success": True, "peer_id": update.peer_id}
 
 @api_router.post("/users/set-offline")
 async def set_offline(current_user: dict = Depends(get_current_user)):
-    await db.users.update_one(
-        {"id": current_user["id"]},
-        {"$set": {"online_status": False}}
-    )
+    queue_status_update(current_user["id"], {"online_status": False})
+    await clear_presence(current_user["id"])
     return {"success": True}
 
 @api_router.get("/users/online")
-async def get_online_users(current_user: dict = Depends(get_current_user)):
-    users = await db.users.find({"online_status": True, "id": {"$ne": current_user["id"]}}, {"_id": 0, "username": 1, "current_peer_id": 1}).to_list(1000)
-    return users
+async def get_online_users(request: Request, current_user: dict = Depends(get_current_user)):
+    user_ids = await redis_client.zrangebyscore(PRESENCE_KEY, time.time() - PRESENCE_TTL, "+inf", start=0, num=1000)
+    user_ids = [user_id for user_id in user_ids if user_id != current_user["id"]]
+    infos = await redis_client.hmget(PRESENCE_INFO_KEY, user_ids) if user_ids else []
+    # Order by username, not heartbeat time, so the ETag only changes when the
+    # set of online users does
+    users = sorted((json.loads(info) for info in infos if info), key=lambda user: user["username"])
+    return cacheable_response(request, users, "private, max-age=3, stale-while-revalidate=10")
 
 
 # ===== BACKUP ENDPOINTS =====
 
 @api_router.post("/backup/upload")
-async def upload_backup(backup: BackupUpload, current_user: dict = Depends(get_current_user)):
-    # Decode and encrypt data
+async def upload_backup(
+    file: UploadFile = File(...),
+    provider: str = Form(...),  # 'local', 'gdrive', 'onedrive', 'dropbox'
+    current_user: dict = Depends(get_current_user)
+):
+    # Read the raw upload in chunks and encrypt it
+    chunks = []
+    while chunk := await file.read(1 << 20):
+        chunks.append(chunk)
     try:
-        data = base64.b64decode(backup.data)
-        encrypted_data = fernet.encrypt(data)
+        encrypted_data = await run_crypto(crypto_ops.encrypt, ENCRYPTION_KEY.encode(), b"".join(chunks), retry=False)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Encryption failed: {str(e)}")
     
     # Create backup metadata
-    metadata = BackupMetadata(
-        user_id=current_user["id"],
-        filename=backup.filename,
-        provider=backup.provider,
-        encrypted_data=base64.b64encode(encrypted_data).decode() if backup.provider == 'local' else None
-    )
+    metadata = {
+        "id": str(uuid.uuid4()),
+        "user_id": current_user["id"],
+        "filename": file.filename,
+        "provider": provider,
+        "encrypted_data": None,  # Legacy inline local storage; new local backups live in GridFS
+        "cloud_file_id": None,  # For cloud storage
+        "created_at": int(time.time())
+    }
     
-    metadata_dict = metadata.model_dump()
-    metadata_dict['created_at'] = metadata_dict['created_at'].isoformat()
+    # Local backups are stored in GridFS under the backup id
+    if provider == 'local':
+        await backup_files.upload_from_stream_with_id(metadata["id"], metadata["filename"], encrypted_data)
     
-    await db.backups.insert_one(metadata_dict)
+    try:
+        await db.backups.insert_one(metadata)
+    except BaseException:
+        # Don't leave the ciphertext behind without metadata pointing at it
+        if provider == 'local':
+            await backup_files.delete(metadata["id"])
+        raise
     
     return {
         "success": True,
-        "backup_id": metadata.id,
+        "backup_id": metadata["id"],
         "message": "Backup uploaded successfully"
     }
 
@@ -358,16 +602,27 @@ async def list_backups(current_user: dict = Depends(get_current_user)):
 
 @api_router.get("/backup/download/{backup_id}")
 async def download_backup(backup_id: str, current_user: dict = Depends(get_current_user)):
-    backup = await db.backups.find_one({"id": backup_id, "user_id": current_user["id"]}, {"_id": 0})
+    backup = await db.backups.find_one(
+        {"id": backup_id, "user_id": current_user["id"]},
+        {"_id": 0, "filename": 1, "provider": 1, "encrypted_data": 1, "created_at": 1}
+    )
     if not backup:
         raise HTTPException(status_code=404, detail="Backup not found")
     
-    if backup["provider"] != "local" or not backup.get("encrypted_data"):
+    if backup["provider"] != "local":
         raise HTTPException(status_code=400, detail="Only local backups can be downloaded via API")
     
-    try:
+    if backup.get("encrypted_data"):
         encrypted_data = base64.b64decode(backup["encrypted_data"])
-        decrypted_data = fernet.decrypt(encrypted_data)
+    else:
+        try:
+            stream = await backup_files.open_download_stream(backup_id)
+        except NoFile:
+            raise HTTPException(status_code=404, detail="Backup data not found")
+        encrypted_data = await stream.read()
+    
+    try:
+        decrypted_data = await run_crypto(crypto_ops.decrypt, ENCRYPTION_KEY.encode(), encrypted_data, retry=False)
         return {
             "filename": backup["filename"],
             "data": base64.b64encode(decrypted_data).decode(),
@@ -378,9 +633,18 @@ async def download_backup(backup_id: str, current_user: dict = Depends(get_curre
 
 @api_router.delete("/backup/{backup_id}")
 async def delete_backup(backup_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.backups.delete_one({"id": backup_id, "user_id": current_user["id"]})
-    if result.deleted_count == 0:
+    backup = await db.backups.find_one_and_delete(
+        {"id": backup_id, "user_id": current_user["id"]},
+        {"_id": 0, "provider": 1, "encrypted_data": 1}
+    )
+    if not backup:
         raise HTTPException(status_code=404, detail="Backup not found")
+    
+    if backup["provider"] == "local" and not backup.get("encrypted_data"):
+        try:
+            await backup_files.delete(backup_id)
+        except NoFile:
+            pass
     return {"success": True, "message": "Backup deleted"}
 
 
@@ -402,6 +666,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    indexes = [
+        (db.users, "id", {"unique": True}),
+        (db.users, "email", {"unique": True}),
+        (db.users, "username", {"unique": True}),
+        (db.backups, "id", {"unique": True}),
+        (db.backups, [("user_id", 1), ("created_at", -1)], {}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except OperationFailure as e:
+            # Most likely duplicate rows from before the unique constraint existed;
+            # the server still starts, but the index must be fixed up by hand.
+            logger.error("Failed to create index %s on %s: %s", keys, collection.name, e)
+
+@app.on_event("startup")
+async def start_crypto_executor():
+    global crypto_executor
+    crypto_executor = new_crypto_executor()
+
+@app.on_event("startup")
+async def start_background_tasks():
+    _background_tasks.append(asyncio.create_task(run_status_flusher()))
+    _background_tasks.append(asyncio.create_task(run_presence_pruner()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    try:
+        await flush_status_updates()
+    except Exception:
+        logger.exception("Failed to flush online status updates on shutdown")
+    await redis_client.aclose()
+    await client.close()
+    if crypto_executor:
+        crypto_executor.shutdown(wait=False, cancel_futures=True)
\ No newline at end of file
@@ -42,7 +42,7 @@ export default function SettingsDialog({ user, onClose }) {
     try {
       const data = await exportDatabase();
       const encrypted = await encryptBackup(data);
-      await uploadToServer(encrypted);
+      await uploadToServer(data);
       
       // Also download locally
       const blob = new Blob([JSON.stringify(encrypted)], { type: 'application/json' });
@@ -93,12 +93,15 @@ export default function SettingsDialog({ user, onClose }) {
     }
   };
 
-  const uploadToServer = async (encrypted) => {
-    await axios.post(`${API}/backup/upload`, {
-      filename: `backup-${new Date().toISOString()}.json`,
-      data: encrypted.data,
-      provider: 'local'
-    });
+  const uploadToServer = async (data) => {
+    const formData = new FormData();
+    formData.append(
+      'file',
+      new Blob([JSON.stringify(data)], { type: 'application/json' }),
+      `backup-${new Date().toISOString()}.json`
+    );
+    formData.append('provider', 'local');
+    await axios.post(`${API}/backup/upload`, formData);
   };
 
   return (
@@ -10,6 +10,8 @@ import { Button } from '../components/ui/button';
 import SettingsDialog from '../components/SettingsDialog';
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+// Presence expires server-side after 30s without a heartbeat
+const PRESENCE_HEARTBEAT_MS = 15000;
 
 export default function MessengerPage({ user, onLogout }) {
   const [peer, setPeer] = useState(null);
@@ -25,6 +27,16 @@ export default function MessengerPage({ user, onLogout }) {
     return () => cleanup();
   }, []);
 
+  useEffect(() => {
+    if (!peerId) return;
+    const heartbeat = setInterval(() => {
+      axios.post(`${API}/users/update-peer-id`, { peer_id: peerId }).catch((error) => {
+        console.error('Failed to refresh presence:', error);
+      });
+    }, PRESENCE_HEARTBEAT_MS);
+    return () => clearInterval(heartbeat);
+  }, [peerId]);
+
   const initializeApp = async () => {
     await initDB();
     await loadContacts();
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "justp2p_test")
+os.environ.setdefault("BACKUP_CODE_KEY", "test-backup-code-key")
+
+import server  # noqa: E402
+
+
+class FakeVerify:
+    """Stands in for server.verify_password; `behaviours` are consumed per call."""
+
+    def __init__(self, *behaviours):
+        self.behaviours = list(behaviours)
+        self.calls = 0
+
+    async def __call__(self, password, hashed):
+        self.calls += 1
+        behaviour = self.behaviours.pop(0) if self.behaviours else None
+        if isinstance(behaviour, Exception):
+            await asyncio.sleep(0.01)
+            raise behaviour
+        await asyncio.sleep(behaviour or 0.01)
+        return password == "right"
+
+
+@pytest.fixture
+def fake_verify(monkeypatch):
+    def install(*behaviours):
+        fake = FakeVerify(*behaviours)
+        monkeypatch.setattr(server, "verify_password", fake)
+        return fake
+    return install
+
+
+def test_waiters_share_the_leaders_result(fake_verify):
+    fake = fake_verify()
+
+    async def scenario():
+        return await asyncio.gather(*[server.verify_password_coalesced("right", "hash") for _ in range(5)])
+
+    assert asyncio.run(scenario()) == [True] * 5
+    assert fake.calls == 1
+    assert server._login_inflight == {}
+
+
+def test_different_passwords_are_not_coalesced(fake_verify):
+    fake = fake_verify()
+
+    async def scenario():
+        return await asyncio.gather(
+            server.verify_password_coalesced("right", "hash"),
+            server.verify_password_coalesced("wrong", "hash"),
+        )
+
+    assert asyncio.run(scenario()) == [True, False]
+    assert fake.calls == 2
+
+
+def test_waiter_times_out_and_checks_on_its_own(fake_verify, monkeypatch):
+    monkeypatch.setattr(server, "LOGIN_COALESCE_TIMEOUT", 0.01)
+    fake = fake_verify(0.2, 0.01)
+
+    async def scenario():
+        leader = asyncio.create_task(server.verify_password_coalesced("right", "hash"))
+        await asyncio.sleep(0)
+        waiter_result = await server.verify_password_coalesced("right", "hash")
+        return waiter_result, await leader
+
+    assert asyncio.run(scenario()) == (True, True)
+    assert fake.calls == 2
+
+
+def test_leader_error_propagates_and_waiter_falls_back(fake_verify):
+    fake = fake_verify(RuntimeError("pool broke"))
+
+    async def scenario():
+        leader = asyncio.create_task(server.verify_password_coalesced("right", "hash"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(server.verify_password_coalesced("right", "hash"))
+        with pytest.raises(RuntimeError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(scenario()) is True
+    assert fake.calls == 2
+    assert server._login_inflight == {}
+
+
+def test_leader_cancelled_and_waiter_falls_back(fake_verify):
+    fake = fake_verify(1.0)
+
+    async def scenario():
+        leader = asyncio.create_task(server.verify_password_coalesced("right", "hash"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(server.verify_password_coalesced("right", "hash"))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result = await waiter
+        assert leader.cancelled()
+        return result
+
+    assert asyncio.run(scenario()) is True
+    assert fake.calls == 2
+
+
+def test_cancelled_waiter_does_not_fall_back(fake_verify):
+    fake = fake_verify(1.0)
+
+    async def scenario():
+        leader = asyncio.create_task(server.verify_password_coalesced("right", "hash"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(server.verify_password_coalesced("right", "hash"))
+        await asyncio.sleep(0)
+        # Cancel the leader, let it cancel the shared future, then cancel the
+        # waiter before it wakes up
+        leader.cancel()
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(leader, waiter, return_exceptions=True)
+        assert waiter.cancelled()
+
+    asyncio.run(scenario())
+    assert fake.calls == 1